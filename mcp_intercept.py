@@ -2,90 +2,200 @@ import logging
 import sys
 import subprocess
 import threading
+import time
 import os
+import queue
+import collections
+import selectors
+import shutil
+import functools
+import itertools
 import argparse
 from websocket_server import WebsocketServer
 import websocket
 
-# Configure logging at module level
-logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+# Configure logging at module level. force=True because websocket_server
+# calls logging.basicConfig() on import, which would make this a no-op.
+logging.basicConfig(stream=sys.stderr,
+                    level=logging.INFO,
+                    format="[%(levelname)s] %(message)s",
+                    force=True)
+
+
+class _ShutdownEvent(threading.Event):
+    """Event that a selector can also wait on, via a self-pipe."""
+
+    def __init__(self):
+        super().__init__()
+        self._wake_r, self._wake_w = os.pipe()
+
+    def fileno(self):
+        """Return a descriptor that becomes readable once the event is set."""
+        return self._wake_r
+
+    def set(self):
+        super().set()
+        try:
+            os.write(self._wake_w, b"\0")
+        except OSError:
+            pass
+
 
 # --- Globals ---
-_client_lock = threading.Lock()
-_client_joined = False
-_shutdown_event = threading.Event()
+# next() on a count is atomic, so only the first handshake gets token 0
+_client_tokens = itertools.count()
+_shutdown_event = _ShutdownEvent()
+_stdin_pending = collections.deque()  # messages waiting for subprocess stdin
+_stdin_ready = threading.Event()
+_stdin_closed = threading.Event()  # set once the stdin writer has exited
 _original_stdout = sys.stdout  # keep protocol writes here
 sys.stdout = sys.stderr  # redirect protocol writes to stderr
+_READ_CHUNK = 65536  # bytes pulled from a subprocess pipe per os.read()
+_STDERR_CHUNK = 16384  # stderr is diagnostics only; smaller reads suffice
+_STDOUT_QUEUE_SIZE = 64  # stdout reads buffered before the reader blocks
+_STDIN_BATCH = 64  # pending messages gathered into one stdin write
+_STDIN_QUEUE_SIZE = 1024  # pending messages before the client is held back
+_stdin_space = threading.Semaphore(_STDIN_QUEUE_SIZE)  # free pending slots
+_PIPE_DRAIN_TIMEOUT = 0.5  # seconds to wait for pipe readers after exit
 
 
 def drain_stderr(proc):
     """Continuously read from subprocess stderr to avoid blocking."""
+    fd = proc.stderr.fileno()
+    read = os.read  # hot-loop names bound once
     try:
+        # Unbuffered pass-through; log records are flushed as they are emitted
+        err_fd = sys.stderr.fileno()
         while True:
-            msg = proc.stderr.readline()
-            if not msg:
+            chunk = read(fd, _STDERR_CHUNK)
+            if not chunk:
                 break
-            sys.stderr.buffer.write(msg.encode("utf-8"))
-            sys.stderr.flush()
+            _write_all(err_fd, [chunk])
     except (BrokenPipeError, ValueError, OSError) as e:
         logging.warning(f"Error draining stderr: {e}")
     except Exception as e:
         logging.error(f"Unexpected error in drain_stderr: {e}")
 
 
-def on_message(client, server, msg: str, proc):
-    """Forward WebSocket message to subprocess stdin."""
+def _write_all(fd, bufs):
+    """Write a list of buffers to fd with as few syscalls as possible."""
+    if not hasattr(os, "writev"):  # Windows
+        view = memoryview(b"".join(bufs))
+        while view:
+            view = view[os.write(fd, view):]
+        return
+    while bufs:
+        written = os.writev(fd, bufs)
+        # writev may stop short; drop what went out and retry the rest
+        while bufs and written >= len(bufs[0]):
+            written -= len(bufs.pop(0))
+        if written:
+            bufs[0] = bufs[0][written:]
+
+
+def ws_to_proc_thread_func(proc):
+    """Write queued WebSocket messages to subprocess stdin.
+
+    This thread owns subprocess stdin and closes it on exit, so the raw fd
+    is never closed under a pending write.
+    """
+    fd = proc.stdin.fileno()
     try:
-        proc.stdin.buffer.write(msg.encode("utf-8"))
-        proc.stdin.flush()
+        while True:
+            _stdin_ready.wait()
+            _stdin_ready.clear()
+            # Read before draining: every message queued ahead of shutdown
+            # is then written before stdin is closed
+            stopping = _shutdown_event.is_set()
+            while _stdin_pending:
+                count = min(len(_stdin_pending), _STDIN_BATCH)
+                _write_all(fd, [_stdin_pending.popleft() for _ in range(count)])
+                _stdin_space.release(count)
+            if stopping:
+                break
     except BrokenPipeError:
-        logging.warning("Subprocess stdin closed; dropping message")
+        logging.warning(f"Subprocess stdin closed; dropping {len(_stdin_pending)} message(s)")
     except (OSError, ValueError) as e:
         logging.warning(f"Error forwarding message to subprocess: {e}")
     except Exception as e:
-        logging.error(f"Unexpected error in on_message: {e}")
+        logging.error(f"Unexpected error in ws_to_proc_thread: {e}")
+    finally:
+        _stdin_closed.set()
+        _stdin_space.release(_STDIN_QUEUE_SIZE)  # unblock a waiting on_message
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
 
+class Relay:
+    """WebSocket server callbacks bound to the relay's queues."""
 
-def on_new_client(client, server, proc):
-    """Handle new client connection."""
-    global _client_joined
-    with _client_lock:
-        if _client_joined:
+    def __init__(self, out_queue):
+        self.out_queue = out_queue
+        # Bound once so each inbound message skips the global/attribute lookups
+        self._stdin_append = _stdin_pending.append
+        self._stdin_wake = _stdin_ready.set
+        self._stdin_reserve = _stdin_space.acquire
+
+    def on_message(self, client, server, msg: str):
+        """Queue WebSocket message for the subprocess stdin writer."""
+        if _stdin_closed.is_set():
+            logging.warning("Subprocess stdin closed; dropping message")
+            return
+        # Blocks this client's handler thread while the writer is behind,
+        # which stops reading from the socket as a blocking write would
+        self._stdin_reserve()
+        if _stdin_closed.is_set():  # writer exited while we waited
+            logging.warning("Subprocess stdin closed; dropping message")
+            return
+        self._stdin_append(msg.encode())  # UTF-8 fast path
+        self._stdin_wake()
+
+    def on_new_client(self, client, server):
+        """Handle new client connection."""
+        if next(_client_tokens) != 0:
             logging.error("Client already joined; ignoring new connection.")
             # Just return - the server will handle the connection normally
             # but we won't process messages from this client
             return
-        _client_joined = True
         logging.info("Client connected")
 
-    t = threading.Thread(target=proc_to_ws_thread_func,
-                         args=(proc, client, server),
-                         daemon=True)
-    t.start()
+        t = threading.Thread(target=queue_to_ws_thread_func,
+                             args=(self.out_queue, client, server),
+                             daemon=True,
+                             name="ws_sender")
+        t.start()
 
 
 def on_client_left(client, server):
     """Handle client disconnection by triggering shutdown."""
-    global _client_joined
-    with _client_lock:
-        _client_joined = False
     logging.info("Client disconnected, initiating shutdown...")
     _shutdown_event.set()
 
 
-def cleanup(proc, server, threads=None):
+def cleanup(proc, server, threads=None, stdin_thread=None, pipe_threads=None):
     """Perform comprehensive cleanup of resources."""
     logging.info("Starting cleanup...")
 
     # Signal shutdown to all threads
     _shutdown_event.set()
 
-    # Close subprocess stdin first to signal it to exit
-    try:
-        if proc.stdin and not proc.stdin.closed:
-            proc.stdin.close()
-    except Exception as e:
-        logging.warning(f"Error closing subprocess stdin: {e}")
+    # Close subprocess stdin first to signal it to exit. The stdin writer
+    # drains what is queued and closes it on its way out; if it is still
+    # writing (a slow or stuck reader), leave stdin to it - terminate()
+    # below breaks the pipe if the subprocess never catches up.
+    _stdin_ready.set()
+    if stdin_thread:
+        stdin_thread.join(timeout=1)
+    if stdin_thread and stdin_thread.is_alive():
+        logging.warning("Subprocess stdin writer still busy; leaving stdin to it")
+    else:
+        try:
+            if proc.stdin and not proc.stdin.closed:
+                proc.stdin.close()
+        except Exception as e:
+            logging.warning(f"Error closing subprocess stdin: {e}")
 
     # Give the process a chance to exit gracefully
     try:
@@ -101,6 +211,12 @@ def cleanup(proc, server, threads=None):
             proc.kill()
             proc.wait()
 
+    # Let the pipe readers forward trailing output. They finish at pipe EOF,
+    # which a grandchild holding the pipes can delay, so keep it short.
+    deadline = time.monotonic() + _PIPE_DRAIN_TIMEOUT
+    for thread in pipe_threads or []:
+        thread.join(timeout=max(0, deadline - time.monotonic()))
+
     # Stop the WebSocket server
     try:
         server.shutdown()
@@ -125,6 +241,12 @@ def cleanup(proc, server, threads=None):
     logging.info("Cleanup completed")
 
 
+@functools.lru_cache(maxsize=None)
+def _which(program):
+    """Cached PATH lookup for a program name."""
+    return shutil.which(program)
+
+
 def validate_args(args):
     """Validate command line arguments."""
     if args.proxy_port < 1 or args.proxy_port > 65535:
@@ -134,39 +256,113 @@ def validate_args(args):
         raise ValueError("Program argument is required")
 
     # Check if the program exists in PATH
-    import shutil
-    if not shutil.which(args.program.split()[0] if ' ' in args.program else args.program):
+    if not _which(args.program.split()[0] if ' ' in args.program else args.program):
         logging.warning(f"Program '{args.program}' not found in PATH")
 
 
-def proc_to_ws_thread_func(proc, client, server):
-    """Read from subprocess stdout and forward to WebSocket."""
+def _split_lines(pending, data):
+    """Return the complete lines in data, each with its newline.
+
+    pending is a bytearray holding the partial line left by earlier reads;
+    it completes the first line and is refilled with whatever follows the
+    last newline. Only data is scanned, so a line spanning many reads
+    costs linear time.
+    """
+    lines = data.split(b"\n")
+    rest = lines.pop()
+    if lines:
+        lines = [line + b"\n" for line in lines]
+        if pending:
+            lines[0] = bytes(pending) + lines[0]
+            pending.clear()
+    pending += rest
+    return lines
+
+
+def proc_to_queue_thread_func(proc, out_queue):
+    """Read from subprocess stdout and queue each read's complete lines."""
+    fd = proc.stdout.fileno()
+    read, split_lines, put = os.read, _split_lines, out_queue.put
+    tail = bytearray()  # partial line, completed by a later read
     try:
         while True:
-            msg = proc.stdout.readline()
-            if not msg:
-                break
-            try:
-                server.send_message(client, msg)
-            except Exception as e:
-                logging.warning(f"Error forwarding message to WebSocket: {e}")
+            data = read(fd, _READ_CHUNK)
+            if not data:
                 break
+            lines = split_lines(tail, data)
+            if lines:
+                put(lines)
+        if tail:
+            out_queue.put([bytes(tail)])  # trailing unterminated line
     except (BrokenPipeError, ValueError, OSError) as e:
         logging.warning(f"Error reading from subprocess stdout: {e}")
     except Exception as e:
-        logging.error(f"Unexpected error in proc_to_ws_thread: {e}")
+        logging.error(f"Unexpected error in proc_to_queue_thread: {e}")
+    finally:
+        out_queue.put(None)  # EOF marker for the sender
+
+
+def queue_to_ws_thread_func(out_queue, client, server):
+    """Send queued subprocess output to WebSocket, one message per line."""
+    get, send = out_queue.get, server.send_message
+    try:
+        while True:
+            lines = get()
+            if lines is None:
+                break
+            # One line per message, so each response can be inspected and
+            # edited on its own in the proxy
+            for line in lines:
+                try:
+                    # websocket_server silently drops invalid UTF-8 text
+                    msg = line.decode()
+                except UnicodeDecodeError:
+                    logging.warning(f"Dropping non-UTF-8 subprocess output: {line[:80]!r}")
+                    continue
+                try:
+                    send(client, msg)
+                except Exception as e:
+                    logging.warning(f"Error forwarding message to WebSocket: {e}")
+                    return
+    except Exception as e:
+        logging.error(f"Unexpected error in queue_to_ws_thread: {e}")
+
+
+class _ReadAheadWebSocket(websocket.WebSocket):
+    """WebSocket client that reads its socket 64 KiB at a time.
+
+    websocket-client asks for each frame header and payload separately;
+    serving those requests from a read-ahead buffer lets one recv()
+    carry several frames instead of costing a few syscalls per frame.
+    Relies on private websocket-client internals; see requirements.txt.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._read_buf = b""
+        self._read_pos = 0
+        super().__init__(*args, **kwargs)
+
+    def _recv(self, bufsize):
+        if self._read_pos >= len(self._read_buf):
+            self._read_buf = super()._recv(_READ_CHUNK)
+            self._read_pos = 0
+        data = self._read_buf[self._read_pos:self._read_pos + bufsize]
+        self._read_pos += len(data)
+        return data
 
 
 def ws_to_client_thread_func(ws):
     """Read from WebSocket and forward to original stdout."""
+    # Nothing else writes the real stdout, so skip its buffer entirely
+    out_fd = _original_stdout.fileno()
     try:
         while True:
             try:
-                msg = ws.recv()
-                if not msg:
+                # Raw frame payload; no decode/encode round trip to stdout
+                opcode, msg = ws.recv_data()
+                if opcode == websocket.ABNF.OPCODE_CLOSE or not msg:
                     break
-                _original_stdout.buffer.write(msg.encode("utf-8"))
-                _original_stdout.flush()
+                _write_all(out_fd, [msg])
             except (websocket.WebSocketConnectionClosedException,
                     websocket._exceptions.WebSocketTimeoutException,
                     ConnectionResetError):
@@ -179,6 +375,38 @@ def ws_to_client_thread_func(ws):
         logging.error(f"Unexpected error in ws_to_client_thread: {e}")
 
 
+def read_stdin_lines():
+    """Yield complete lines from stdin until EOF or shutdown."""
+    if sys.platform == "win32":
+        # Windows cannot select() on console or pipe handles
+        readline = sys.stdin.buffer.readline
+        while not _shutdown_event.is_set():
+            msg = readline()
+            if not msg:
+                return
+            yield msg
+        return
+
+    fd = sys.stdin.fileno()
+    tail = bytearray()
+    # select() rather than epoll, which refuses regular files (stdin < file)
+    with selectors.SelectSelector() as sel:
+        sel.register(fd, selectors.EVENT_READ)
+        sel.register(_shutdown_event, selectors.EVENT_READ)
+        while True:
+            events = sel.select()
+            if any(key.fileobj is _shutdown_event for key, _ in events):
+                return
+            data = os.read(fd, _READ_CHUNK)
+            if not data:
+                break
+            # One line per WebSocket message, so each request can be
+            # inspected and replayed on its own in the proxy
+            yield from _split_lines(tail, data)
+    if tail:
+        yield bytes(tail)  # trailing unterminated line
+
+
 def client_thread_func(server_address, proxy_port):
     """Connect a WebSocket client (optionally via proxy) and relay stdin/stdout."""
     url = f"ws://{server_address[0]}:{server_address[1]}"
@@ -188,21 +416,17 @@ def client_thread_func(server_address, proxy_port):
     try:
         ws = websocket.create_connection(url,
                                          http_proxy_host="127.0.0.1",
-                                         http_proxy_port=proxy_port)
+                                         http_proxy_port=proxy_port,
+                                         skip_utf8_validation=True,
+                                         class_=_ReadAheadWebSocket)
 
         t = threading.Thread(target=ws_to_client_thread_func, args=(ws,), daemon=True)
         t.start()
 
         try:
-            while not _shutdown_event.is_set():
-                # Cross-platform non-blocking stdin read
-                try:
-                    msg = sys.stdin.readline()
-                    if not msg:
-                        break
-                    ws.send(msg)
-                except Exception as e:
-                    logging.warning(f"Error reading from stdin: {e}")
+            # Returns as soon as shutdown is signaled, even with stdin idle
+            for msg in read_stdin_lines():
+                ws.send(msg)
         except KeyboardInterrupt:
             logging.info("Received keyboard interrupt")
         except Exception as e:
@@ -250,24 +474,37 @@ def main():
                                 stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
-                                text=True,
-                                bufsize=1,
-                                env=env,
-                                encoding="utf-8")
+                                bufsize=0,
+                                env=env)
 
         stderr_thread = threading.Thread(target=drain_stderr,
                                          args=(proc, ),
                                          daemon=True,
                                          name="stderr_drain")
         stderr_thread.start()
-        threads.append(stderr_thread)
+
+        stdin_thread = threading.Thread(target=ws_to_proc_thread_func,
+                                        args=(proc, ),
+                                        daemon=True,
+                                        name="stdin_writer")
+        stdin_thread.start()
+        threads.append(stdin_thread)
+
+        # Stdout is read independently of the WebSocket sender, so a slow
+        # send does not leave the subprocess blocked on a full pipe
+        stdout_queue = queue.Queue(maxsize=_STDOUT_QUEUE_SIZE)
+        stdout_thread = threading.Thread(target=proc_to_queue_thread_func,
+                                         args=(proc, stdout_queue),
+                                         daemon=True,
+                                         name="stdout_reader")
+        stdout_thread.start()
 
         server = WebsocketServer(host="127.0.0.1",
                                  port=0,
                                  loglevel=logging.ERROR)
-        server.set_fn_message_received(
-            lambda c, s, m: on_message(c, s, m, proc))
-        server.set_fn_new_client(lambda c, s: on_new_client(c, s, proc))
+        relay = Relay(stdout_queue)
+        server.set_fn_message_received(relay.on_message)
+        server.set_fn_new_client(relay.on_new_client)
         server.set_fn_client_left(on_client_left)
 
         host, port = server.server_address
@@ -302,13 +539,14 @@ def main():
     finally:
         if proc and server:
             try:
-                cleanup(proc, server, threads)
+                cleanup(proc, server, threads,
+                        stdin_thread=stdin_thread,
+                        pipe_threads=[stderr_thread, stdout_thread])
             except KeyboardInterrupt:
                 logging.info("Cleanup interrupted, forcing exit...")
                 # Force cleanup of critical resources
                 try:
-                    if proc.stdin and not proc.stdin.closed:
-                        proc.stdin.close()
+                    # stdin is left to its writer thread; see cleanup()
                     proc.terminate()
                 except:
                     pass